@@ -1,14 +1,39 @@
-from fastapi import FastAPI, Request, Depends, Header, HTTPException
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import datetime, timedelta, timezone
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
 import firebase_admin
-from firebase_admin import credentials, firestore, auth as firebase_auth
+from firebase_admin import credentials, firestore, firestore_async, auth as firebase_auth
+from google.api_core import exceptions as gcp_exceptions, retry_async
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
-import os, json, pathlib
-from pydantic import BaseModel, EmailStr
-from typing import Optional
+import os, pathlib
+import asyncio
+import atexit
+import orjson
+import logging
+import logging.handlers
+import queue
+import time
+from types import MappingProxyType
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, ValidationError, field_validator
+from typing import Dict, Optional, Tuple
+from collections import defaultdict
 import secrets
-import smtplib
+import string
+import functools
+import operator
+import hashlib
+from cachetools import TTLCache
+try:
+    from ciso8601 import parse_datetime as _parse_iso
+except ImportError:
+    def _parse_iso(value: str) -> datetime:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+import aiosmtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
@@ -17,10 +42,142 @@ from email.mime.multipart import MIMEMultipart
 # ----------------------------------------------------------------
 load_dotenv()
 
+# ----------------------------------------------------------------
+#  --- LOGGING ---
+# ----------------------------------------------------------------
+# Per-request detail is logged at DEBUG; set LOG_LEVEL=DEBUG to see it.
+# Records are handed to a queue and written to stderr by a listener thread,
+# so formatting and the write itself stay off the event loop.
+_log_queue = queue.SimpleQueue()
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# The queue side only merges the message arguments; the listener's handler
+# applies the real format
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    handlers=[_queue_handler],
+)
+# Started at import so records logged before (or without) the ASGI lifespan
+# are written; stopped once at exit, after the shutdown logs are queued
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger = logging.getLogger(__name__)
+
 # ----------------------------------------------------------------
 #  --- INIT FASTAPI ---
 # ----------------------------------------------------------------
-app = FastAPI(title="Tree-D Backend", version="2.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Warm up the Firestore channel on startup; flush pending increments
+    and close the SMTP sessions on shutdown
+    """
+    try:
+        # Any cheap RPC opens the gRPC channel and fetches the OAuth token
+        await db.collection("stored_data2").limit(1).get()
+    except Exception as e:
+        logger.warning("⚠️ Firestore warm-up failed: %s", e)
+    yield
+    await flush_writes()
+    await smtp_pool.close()
+
+app = FastAPI(
+    title="Tree-D Backend",
+    version="2.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+# ----------------------------------------------------------------
+#  --- AUTH MIDDLEWARE (Firebase Token Check) ---
+# ----------------------------------------------------------------
+# Paths that need a signed-in dashboard user. The token is checked in a plain
+# ASGI middleware, so protected requests skip a Header dependency and the rest
+# (device scans, invite validation, /gettime) pass straight through.
+PROTECTED_PREFIXES = (
+    "/invite/send",
+    "/invite/accept/",
+    "/invite/list",
+    "/user/",
+    "/team/",
+    "/getdata",
+    "/analytics/",
+)
+
+# Decoded tokens keyed by a hash of the raw token. Firebase ID tokens last an
+# hour; entries go after 55 minutes or 30s before the token's own exp, whichever is first.
+_token_cache = TTLCache(maxsize=10000, ttl=3300)
+
+
+async def verify_firebase_token(authorization: Optional[str]):
+    """
+    Verifies the Firebase ID token from an Authorization header value.
+    Expected format: 'Bearer <token>'
+    """
+    if not authorization:
+        raise HTTPException(status_code=401, detail="Missing Authorization header")
+
+    if not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Invalid token format")
+
+    token = authorization.split("Bearer ")[1]
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    decoded_token = _token_cache.get(cache_key)
+    # Leave 30s of slack so a token isn't served from cache right up to its
+    # expiry; near the end it goes back through full verification
+    if decoded_token and decoded_token["exp"] - 30 > time.time():
+        return decoded_token
+
+    try:
+        # May fetch Google's public keys, so keep it off the event loop
+        decoded_token = await asyncio.to_thread(firebase_auth.verify_id_token, token)
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=f"Invalid or expired token: {e}")
+
+    _token_cache[cache_key] = decoded_token
+    return decoded_token
+
+
+class FirebaseAuthMiddleware:
+    """Verifies the bearer token on protected paths and sets request.state.user"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(PROTECTED_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        authorization = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                authorization = value.decode("latin-1")
+                break
+
+        try:
+            user = await verify_firebase_token(authorization)
+        except HTTPException as e:
+            response = ORJSONResponse({"detail": e.detail}, status_code=e.status_code)
+            await response(scope, receive, send)
+            return
+
+        scope.setdefault("state", {})["user"] = user
+        await self.app(scope, receive, send)
+
+
+def current_user(request: Request):
+    """Decoded token of the signed-in user, set by FirebaseAuthMiddleware"""
+    return request.state.user
+
+
+# Added first so it runs inside CORS: preflights never reach it and its 401s
+# still carry the CORS headers the dashboard needs to read them
+app.add_middleware(FirebaseAuthMiddleware)
 
 # ----------------------------------------------------------------
 #  --- CORS ---
@@ -32,44 +189,299 @@ app.add_middleware(
         "https://tree-d-dashboard.vercel.app",
     ],
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    # Every route is a GET or POST carrying at most a bearer token and a JSON body
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
 )
 
+# ----------------------------------------------------------------
+#  --- COMPRESSION ---
+# ----------------------------------------------------------------
+# /getdata and the analytics endpoints return repetitive JSON that grows with
+# the fleet; small responses (e.g. /postdata acks) are left uncompressed.
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
+
 # ----------------------------------------------------------------
 #  --- INIT FIREBASE ---
 # ----------------------------------------------------------------
-if not firebase_admin._apps:
-    firebase_creds = os.getenv("FIREBASE_CREDENTIALS")
-    if not firebase_creds:
+@functools.lru_cache(maxsize=1)
+def _load_creds():
+    """Service-account dict from FIREBASE_CREDENTIALS, given inline or as a path to the key file"""
+    raw = os.getenv("FIREBASE_CREDENTIALS")
+    if not raw:
         raise ValueError("Missing FIREBASE_CREDENTIALS env variable!")
-    cred_dict = json.loads(firebase_creds)
-    cred = credentials.Certificate(cred_dict)
+    if raw.lstrip().startswith("{"):
+        return orjson.loads(raw)
+    with open(raw, "rb") as f:
+        return orjson.loads(f.read())
+
+
+if not firebase_admin._apps:
+    cred = credentials.Certificate(_load_creds())
     firebase_admin.initialize_app(cred)
 
-db = firestore.client()
+db = firestore_async.client()
+
+
+@functools.lru_cache(maxsize=256)
+def device_ref(collection: str, device_id: str):
+    """DocumentReference for a per-device document, reused across scans"""
+    return db.collection(collection).document(device_id)
 
 # ----------------------------------------------------------------
-#  --- AUTH MIDDLEWARE (Firebase Token Check) ---
+#  --- BATCHED COUNTER WRITER ---
 # ----------------------------------------------------------------
-async def verify_firebase_token(authorization: str = Header(None)):
+# Counter increments on stored_data2 and the completion aggregate are summed
+# in memory per (document, field) and flushed shortly after in WriteBatches, so a burst of scans costs one
+# Increment(n) per field instead of a Firestore round-trip per scan. Every
+# enqueue returns the future of the flush that will carry it and /postdata
+# awaits it: on serverless the instance can be frozen as soon as the response
+# is sent, so nothing may be left for a detached task to finish. Writes to
+# stored_data1 stay synchronous because the next scan from the same device
+# reads them back.
+# Firestore's sustained write ceiling is ~10k/s per database; split it across
+# the uvicorn workers so together they stay under it.
+MAX_WRITES_PER_SEC = max(1, 10000 // int(os.getenv("WEB_CONCURRENCY", "1")))
+_write_limiter = AsyncLimiter(MAX_WRITES_PER_SEC, time_period=1.0)
+
+# Stays under Firestore's 500 writes per batch, and under the limiter's
+# capacity, which can't grant more than MAX_WRITES_PER_SEC at once
+BATCH_SIZE = min(450, MAX_WRITES_PER_SEC)
+FLUSH_INTERVAL = 0.05     # seconds to collect increments before committing
+
+# Increments aren't idempotent, so only retry errors where the commit was
+# rejected outright; DeadlineExceeded may already have been applied.
+_REJECTED_ERRORS = (
+    gcp_exceptions.Aborted,
+    gcp_exceptions.ResourceExhausted,
+    gcp_exceptions.ServiceUnavailable,
+)
+_COMMIT_RETRY = retry_async.AsyncRetry(
+    predicate=retry_async.if_exception_type(*_REJECTED_ERRORS),
+    initial=0.1,
+    maximum=2.0,
+    multiplier=1.5,
+    deadline=10.0,
+)
+
+# Museum-wide {slot: {lang: {"total", "completed"}}} counters, kept alongside
+# the per-device ones so the completion analytics read a single document.
+# Every statue scan touches this document and COMPLETION_TOTALS, and
+# Firestore only sustains about one write per second per document, so both
+# are flushed on AGG_FLUSH_INTERVAL rather than FLUSH_INTERVAL.
+COMPLETION_AGG = ("agg", "completions")
+# Museum-wide {"total_listens", "completed_listens"}, for the summary that
+# doesn't need the per-artifact breakdown
+COMPLETION_TOTALS = ("agg", "totals")
+_TOTALS_FIELDS = {"total": "total_listens", "completed": "completed_listens"}
+AGG_FLUSH_INTERVAL = 1.0  # seconds; one write per aggregate document per worker per second
+
+# A rejected batch is queued again at most this many times before its
+# increments are dropped and the waiting requests get the error
+MAX_REQUEUES = 1
+
+
+def _build_payloads(counts):
     """
-    Verifies the Firebase ID token from the Authorization header.
-    Expected format: 'Bearer <token>'
+    Merge pending counts into one nested payload per document.
+    A batch may not contain two writes to the same document.
     """
-    if not authorization:
-        raise HTTPException(status_code=401, detail="Missing Authorization header")
+    payloads = {}
+    for (doc, path), n in counts.items():
+        node = payloads.setdefault(doc, {})
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+        node[path[-1]] = firestore.Increment(n)
+    return payloads
+
+
+async def _commit_payloads(payloads):
+    await _write_limiter.acquire(len(payloads))
+    batch = db.batch()
+    for (collection, doc_id), payload in payloads:
+        batch.set(device_ref(collection, doc_id), payload, merge=True)
+    await batch.commit(retry=_COMMIT_RETRY)
+    logger.debug("💾 [WRITER] Committed increments for %s documents", len(payloads))
+
+
+def _resolve_flush(waiters: asyncio.Future, done: asyncio.Future):
+    if waiters.done():
+        return
+    if done.exception() is not None:
+        waiters.set_exception(done.exception())
+    else:
+        waiters.set_result(None)
 
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid token format")
 
-    token = authorization.split("Bearer ")[1]
+class CounterQueue:
+    """
+    Pending increments for a set of documents, committed every `interval`
+    seconds while any are queued.
+    """
 
-    try:
-        decoded_token = firebase_auth.verify_id_token(token)
-        return decoded_token
-    except Exception as e:
-        raise HTTPException(status_code=401, detail=f"Invalid or expired token: {e}")
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.pending: Dict[Tuple[Tuple[str, str], Tuple[str, ...]], int] = defaultdict(int)
+        self._requeues: Dict[Tuple[str, str], int] = {}
+        self._waiters: Optional[asyncio.Future] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def enqueue(self, doc: Tuple[str, str], path: Tuple[str, ...]) -> asyncio.Future:
+        """Count a +1 and return the future of the flush that will carry it"""
+        self.pending[(doc, path)] += 1
+        if self._waiters is None:
+            self._waiters = asyncio.get_running_loop().create_future()
+        self._schedule()
+        return self._waiters
+
+    def _schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        # Keep going while increments arrive during a commit
+        while self.pending:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        """
+        Commit every pending increment and resolve the waiting future.
+        Batches Firestore rejected outright are queued again (up to
+        MAX_REQUEUES times) and their waiters carried over to the next flush;
+        any other failure may already have been applied, so it is raised to
+        the waiters instead of retried.
+        """
+        if not self.pending:
+            return
+        counts = dict(self.pending)
+        self.pending.clear()
+        waiters, self._waiters = self._waiters, None
+
+        error = None
+        requeued = False
+        payloads = list(_build_payloads(counts).items())
+        for i in range(0, len(payloads), BATCH_SIZE):
+            chunk = payloads[i:i + BATCH_SIZE]
+            try:
+                await _commit_payloads(chunk)
+                for doc, _ in chunk:
+                    self._requeues.pop(doc, None)
+            except (gcp_exceptions.RetryError, *_REJECTED_ERRORS) as e:
+                retry_docs = set()
+                for doc, _ in chunk:
+                    attempts = self._requeues.get(doc, 0) + 1
+                    if attempts > MAX_REQUEUES:
+                        self._requeues.pop(doc, None)
+                        error = e
+                    else:
+                        self._requeues[doc] = attempts
+                        retry_docs.add(doc)
+                if retry_docs:
+                    logger.warning("⚠️ [WRITER] Increments for %s documents rejected, re-queued: %s", len(retry_docs), e)
+                    for key, n in counts.items():
+                        if key[0] in retry_docs:
+                            self.pending[key] += n
+                    requeued = True
+                if len(retry_docs) < len(chunk):
+                    logger.error("❌ [WRITER] Dropped increments for %s documents after %s attempts: %s",
+                                 len(chunk) - len(retry_docs), MAX_REQUEUES + 1, e)
+            except Exception as e:
+                logger.error("❌ [WRITER] Failed to commit increments for %s documents: %s", len(chunk), e)
+                error = e
+
+        if requeued:
+            self._schedule()
+        if waiters is None:
+            return
+        if error is not None:
+            waiters.set_exception(error)
+        elif requeued:
+            if self._waiters is None:
+                self._waiters = waiters
+            else:
+                self._waiters.add_done_callback(functools.partial(_resolve_flush, waiters))
+        else:
+            waiters.set_result(None)
+
+
+_device_counters = CounterQueue(FLUSH_INTERVAL)
+_agg_counters = CounterQueue(AGG_FLUSH_INTERVAL)
+
+
+def enqueue_increment(device_id: str, *path: str) -> asyncio.Future:
+    """Count a +1 on the nested field `path` of stored_data2/<device_id>"""
+    return _device_counters.enqueue(("stored_data2", device_id), path)
+
+
+def enqueue_completion_stat(slot: str, lang: str, field: str) -> asyncio.Future:
+    """Count a +1 on agg/completions.<slot>.<lang>.<field> and its museum-wide total"""
+    _agg_counters.enqueue(COMPLETION_AGG, (slot, lang, field))
+    return _agg_counters.enqueue(COMPLETION_TOTALS, (_TOTALS_FIELDS[field],))
+
+
+async def flush_writes():
+    """Commit every pending increment"""
+    await _device_counters.flush()
+    await _agg_counters.flush()
+
+# ----------------------------------------------------------------
+#  --- STORED_DATA2 SNAPSHOT CACHE ---
+# ----------------------------------------------------------------
+# /getdata returns the whole stored_data2 collection. Cache it briefly so a
+# burst of dashboard reads shares one collection scan. Counter writes land
+# every few hundred milliseconds under load, so they don't invalidate it (it
+# would hardly ever be fresh); readers see them within SNAPSHOT_TTL, and the
+# admin cache endpoint forces a refresh.
+SNAPSHOT_TTL = 5  # seconds
+
+_snapshot_cache = {"ts": 0.0, "generation": 0, "chunks": []}
+_snapshot_lock: Optional[asyncio.Lock] = None
+
+
+def invalidate_snapshot():
+    _snapshot_cache["ts"] = 0.0
+    _snapshot_cache["generation"] += 1
+
+
+def _json_default(value):
+    # Firestore timestamps come back as a datetime subclass orjson won't take
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError
+
+
+def dumps(value) -> bytes:
+    return orjson.dumps(value, default=_json_default)
+
+
+async def stream_stored_data():
+    """
+    Yield stored_data2 documents as encoded JSON objects.
+    Served from the snapshot while it is fresh; otherwise one request re-reads
+    the collection under the lock and everyone streams the result after it is
+    released, so a slow client can't hold up the others.
+    """
+    global _snapshot_lock
+    if _snapshot_lock is None:
+        _snapshot_lock = asyncio.Lock()
+
+    if time.monotonic() - _snapshot_cache["ts"] > SNAPSHOT_TTL:
+        async with _snapshot_lock:
+            # Another request may have refreshed it while we waited
+            if time.monotonic() - _snapshot_cache["ts"] > SNAPSHOT_TTL:
+                generation = _snapshot_cache["generation"]
+                fresh = []
+                async for d in db.collection("stored_data2").stream():
+                    fresh.append(dumps({"id": d.id, **(d.to_dict() or {})}))
+                _snapshot_cache["chunks"] = fresh
+                # Don't mark fresh if it was invalidated while we were reading
+                if generation == _snapshot_cache["generation"]:
+                    _snapshot_cache["ts"] = time.monotonic()
+                logger.debug("🧾 Refreshed stored_data2 snapshot with %s documents.", len(fresh))
+
+    for chunk in _snapshot_cache["chunks"]:
+        yield chunk
 
 # ----------------------------------------------------------------
 #  --- MODELS ---
@@ -83,86 +495,223 @@ class TeamInfo(BaseModel):
     team_name: str
     role: str
 
+class ScanIn(BaseModel):
+    """Scan posted by a handset, normalised for routing; the raw body is what gets stored"""
+    model_config = ConfigDict(extra="allow", populate_by_name=True)
+
+    id: Optional[str] = None
+    statue: Optional[str] = None
+    language: Optional[str] = None
+    event: Optional[str] = None
+    type_: Optional[str] = Field(None, alias="type")
+
+    @field_validator("*", mode="before")
+    @classmethod
+    def _strip(cls, value):
+        # Handsets send numeric ids and padded names; blank means missing
+        if value is None:
+            return None
+        value = str(value).strip()
+        return value or None
+
 # ----------------------------------------------------------------
 #  --- HELPER FUNCTIONS ---
 # ----------------------------------------------------------------
 async def get_user_team(uid: str):
     """Get user's team information from Firestore"""
-    user_doc = db.collection("users").document(uid).get()
+    user_doc = await db.collection("users").document(uid).get()
     if user_doc.exists:
         data = user_doc.to_dict()
         return data.get("team_id"), data.get("role")
     return None, None
 
-import os
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 
-async def send_invite_email(to_email: str, invite_token: str, inviter_email: str, team_name: str):
-    """Send invitation email"""
-    # Get SMTP settings from environment
-    smtp_host = os.getenv("SMTP_HOST", "smtp.gmail.com")
-    smtp_port = int(os.getenv("SMTP_PORT", "587"))
-    smtp_user = os.getenv("SMTP_USER")
-    smtp_password = os.getenv("SMTP_PASSWORD")
-    frontend_url = os.getenv("FRONTEND_URL", "http://localhost:3000")
-    
-    if not smtp_user or not smtp_password:
-        print("⚠️ SMTP credentials not configured")
-        return False
-    
-    invite_link = f"{frontend_url}/accept-invite?token={invite_token}"
-    
-    msg = MIMEMultipart("alternative")
-    msg["Subject"] = f"You've been invited to join {team_name}"
-    msg["From"] = smtp_user
-    msg["To"] = to_email
+async def get_registered_user_team(email: str):
+    """Team ID of the existing account with this email, or None"""
+    try:
+        existing_user = await asyncio.to_thread(firebase_auth.get_user_by_email, email)
+    except firebase_auth.UserNotFoundError:
+        return None  # User doesn't exist yet, which is fine
+    team_id, _ = await get_user_team(existing_user.uid)
+    return team_id
+
+
+async def mark_invites_expired(invite_ids):
+    """Set status "expired" on the given invites, in batches"""
+    for i in range(0, len(invite_ids), BATCH_SIZE):
+        batch = db.batch()
+        for invite_id in invite_ids[i:i + BATCH_SIZE]:
+            batch.update(db.collection("invites").document(invite_id), {"status": "expired"})
+        await batch.commit()
+    logger.debug("⌛ Marked %s invites expired", len(invite_ids))
+
+
+async def get_pending_invite(token: str):
+    """
+    Find the unexpired pending invite for a token.
+    Raises 410 (and marks it expired) if it has lapsed, 404 if there is none.
+    """
+    pending = (
+        db.collection("invites")
+        .where("token", "==", token)
+        .where("status", "==", "pending")
+        .select(["email", "team_id", "team_name", "role", "expires_at"])
+        .limit(1)
+    )
+    # Expiry is filtered server-side, so the happy path is one unary get()
+    # (uses the token/status/expires_at index in firestore.indexes.json).
+    # Until that index is deployed the query fails; fall back to the
+    # lookup below, which checks expiry here instead.
+    try:
+        invites = await pending.where("expires_at", ">", datetime.now(timezone.utc)).get()
+    except gcp_exceptions.FailedPrecondition as e:
+        logger.warning("⚠️ Invite expiry index missing, checking expiry in Python: %s", e)
+        invites = None
+    if invites:
+        return invites[0]
+
+    # Tell a lapsed invite apart from an unknown token. Invites without an
+    # expires_at never match the range filter but don't expire either.
+    invites = await pending.get()
+    if not invites:
+        raise HTTPException(status_code=404, detail="Invalid or expired invitation")
+    invite_doc = invites[0]
+    expires_at = (invite_doc.to_dict() or {}).get("expires_at")
+    if expires_at is None or expires_at > datetime.now(timezone.utc):
+        return invite_doc
+    await db.collection("invites").document(invite_doc.id).update({"status": "expired"})
+    raise HTTPException(status_code=410, detail="This invitation has expired")
+
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
 
-    # prettier HTML version of the email
-    html = f"""
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+
+
+class SMTPPool:
+    """
+    A few authenticated SMTP sessions fed from one queue. Each worker keeps
+    its session open between messages, so only its first email (or the first
+    after the server drops it) pays for connect + STARTTLS + AUTH, and a burst
+    of invites goes out over several sessions in parallel.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers = []
+
+    async def send(self, msg):
+        """Queue a message and wait until it has been handed to the server"""
+        if self._queue is None:
+            # Created on first use so they bind to the running event loop
+            self._queue = asyncio.Queue()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.size)]
+        done = asyncio.get_running_loop().create_future()
+        await self._queue.put((msg, done))
+        await done
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        conn = aiosmtplib.SMTP(hostname=SMTP_HOST, port=SMTP_PORT, start_tls=False, use_tls=False)
+        try:
+            await conn.connect()
+            await conn.starttls()
+            await conn.login(SMTP_USER, SMTP_PASSWORD)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    async def _worker(self):
+        conn = None
+        try:
+            while True:
+                msg, done = await self._queue.get()
+                try:
+                    if conn is None or not conn.is_connected:
+                        conn = await self._connect()
+                    try:
+                        await conn.send_message(msg)
+                    except aiosmtplib.SMTPServerDisconnected:
+                        # The idle session timed out on the server's side; reconnect once
+                        conn = await self._connect()
+                        await conn.send_message(msg)
+                    # The caller may have been cancelled while we were sending
+                    if not done.done():
+                        done.set_result(None)
+                except Exception as e:
+                    # Drop the session rather than reuse one in an unknown state
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                    if not done.done():
+                        done.set_exception(e)
+        finally:
+            if conn is not None and conn.is_connected:
+                try:
+                    await conn.quit()
+                except aiosmtplib.SMTPException:
+                    pass
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+
+smtp_pool = SMTPPool(SMTP_POOL_SIZE)
+
+
+# Prettier HTML version of the invite email, parsed once at import
+_INVITE_HTML = string.Template("""
     <!DOCTYPE html>
     <html>
       <head>
         <meta charset="UTF-8" />
         <title>You're Invited!</title>
         <style>
-          body {{
+          body {
             background-color: #f4f7f9;
             font-family: "Poppins", Arial, sans-serif;
             color: #333;
             margin: 0;
             padding: 0;
-          }}
-          .container {{
+          }
+          .container {
             max-width: 500px;
             margin: 40px auto;
             background: #ffffff;
             border-radius: 16px;
             padding: 30px;
             box-shadow: 0 6px 20px rgba(0, 0, 0, 0.05);
-          }}
-          .logo {{
+          }
+          .logo {
             text-align: center;
             margin-bottom: 20px;
-          }}
-          .logo img {{
+          }
+          .logo img {
             width: 150px;
             border-radius: 12px;
-          }}
-          h1 {{
+          }
+          h1 {
             text-align: center;
             font-size: 1.6rem;
             margin-bottom: 10px;
             color: #2c3e50;
-          }}
-          p {{
+          }
+          p {
             font-size: 1rem;
             line-height: 1.6;
             color: #555;
             margin-bottom: 20px;
-          }}
-          .button {{
+          }
+          .button {
             display: block;
             width: 80%;
             margin: 25px auto 10px;
@@ -174,23 +723,23 @@ async def send_invite_email(to_email: str, invite_token: str, inviter_email: str
             padding: 14px 0;
             border-radius: 10px;
             transition: all 0.3s ease;
-          }}
-          .button:hover {{
+          }
+          .button:hover {
             background-color: #256427;
-          }}
-          .note {{
+          }
+          .note {
             text-align: center;
             font-size: 0.9rem;
             color: #888;
             margin-top: 5px;
             margin-bottom: 20px;
-          }}
-          .footer {{
+          }
+          .footer {
             text-align: center;
             margin-top: 30px;
             font-size: 0.9rem;
             color: #aaa;
-          }}
+          }
         </style>
       </head>
 
@@ -205,13 +754,13 @@ async def send_invite_email(to_email: str, invite_token: str, inviter_email: str
 
           <p>
             Hey there 👋 <br />
-            <strong>{inviter_email}</strong> has invited you to join the team:
-            <strong>{team_name}</strong>.
+            <strong>${inviter_email}</strong> has invited you to join the team:
+            <strong>${team_name}</strong>.
           </p>
 
           <p>Click the button below to accept the invitation and create your account.</p>
 
-          <a href="{invite_link}" class="button">Accept Invitation</a>
+          <a href="${invite_link}" class="button">Accept Invitation</a>
 
           <p class="note">This invitation will expire in 7 days.</p>
 
@@ -221,20 +770,37 @@ async def send_invite_email(to_email: str, invite_token: str, inviter_email: str
         </div>
       </body>
     </html>
-    """
+    """)
+
+
+async def send_invite_email(to_email: str, invite_token: str, inviter_email: str, team_name: str):
+    """Send invitation email"""
+    if not SMTP_USER or not SMTP_PASSWORD:
+        logger.warning("⚠️ SMTP credentials not configured")
+        return False
+    
+    invite_link = f"{FRONTEND_URL}/accept-invite?token={invite_token}"
+    
+    msg = MIMEMultipart("alternative")
+    msg["Subject"] = f"You've been invited to join {team_name}"
+    msg["From"] = SMTP_USER
+    msg["To"] = to_email
+
+    html = _INVITE_HTML.substitute(
+        inviter_email=inviter_email,
+        team_name=team_name,
+        invite_link=invite_link,
+    )
 
     part = MIMEText(html, "html")
     msg.attach(part)
     
     try:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.sendmail(smtp_user, to_email, msg.as_string())
-        print(f"✅ Invite email sent to {to_email}")
+        await smtp_pool.send(msg)
+        logger.info("✅ Invite email sent to %s", to_email)
         return True
     except Exception as e:
-        print(f"❌ Failed to send email: {e}")
+        logger.error("❌ Failed to send email: %s", e)
         return False
 
 # ----------------------------------------------------------------
@@ -242,7 +808,11 @@ async def send_invite_email(to_email: str, invite_token: str, inviter_email: str
 # ----------------------------------------------------------------
 
 @app.post("/invite/send")
-async def send_invite(invite: InviteRequest, user=Depends(verify_firebase_token)):
+async def send_invite(
+    invite: InviteRequest,
+    background_tasks: BackgroundTasks,
+    user=Depends(current_user)
+):
     """
     Send an invitation to a new user
     Only admins with a team can send invites
@@ -250,10 +820,21 @@ async def send_invite(invite: InviteRequest, user=Depends(verify_firebase_token)
     uid = user["uid"]
     email = user.get("email", "Unknown")
     
-    print(f"📨 [INVITE] Request from {email} (UID: {uid}) to invite {invite.email}")
+    logger.info("📨 [INVITE] Request from %s (UID: %s) to invite %s", email, uid, invite.email)
     
-    # Check if user is admin and has a team
-    team_id, role = await get_user_team(uid)
+    # Check if user is admin and has a team; look up the invitee's pending
+    # invites and existing account at the same time
+    pending_query = (
+        db.collection("invites")
+        .where("email", "==", invite.email)
+        .where("status", "==", "pending")
+        .limit(1)
+    )
+    (team_id, role), existing_invite, existing_user_team = await asyncio.gather(
+        get_user_team(uid),
+        pending_query.get(),
+        get_registered_user_team(invite.email),
+    )
     
     if not team_id:
         raise HTTPException(status_code=403, detail="You must be part of a team to send invites")
@@ -262,7 +843,7 @@ async def send_invite(invite: InviteRequest, user=Depends(verify_firebase_token)
         raise HTTPException(status_code=403, detail="Only admins can send invites")
     
     # Get team info
-    team_doc = db.collection("teams").document(team_id).get()
+    team_doc = await db.collection("teams").document(team_id).get()
     if not team_doc.exists:
         raise HTTPException(status_code=404, detail="Team not found")
     
@@ -270,18 +851,11 @@ async def send_invite(invite: InviteRequest, user=Depends(verify_firebase_token)
     team_name = team_data.get("name", "Unknown Team")
     
     # Check if email is already invited or part of a team
-    existing_invite = db.collection("invites").where("email", "==", invite.email).where("status", "==", "pending").limit(1).get()
-    if len(list(existing_invite)) > 0:
+    if existing_invite:
         raise HTTPException(status_code=400, detail="This email already has a pending invitation")
     
-    # Check if user already exists
-    try:
-        existing_user = firebase_auth.get_user_by_email(invite.email)
-        user_doc = db.collection("users").document(existing_user.uid).get()
-        if user_doc.exists and user_doc.to_dict().get("team_id"):
-            raise HTTPException(status_code=400, detail="This user is already part of a team")
-    except firebase_auth.UserNotFoundError:
-        pass  # User doesn't exist yet, which is fine
+    if existing_user_team:
+        raise HTTPException(status_code=400, detail="This user is already part of a team")
     
     # Generate invite token
     invite_token = secrets.token_urlsafe(32)
@@ -300,12 +874,16 @@ async def send_invite(invite: InviteRequest, user=Depends(verify_firebase_token)
         "expires_at": datetime.now().replace(hour=23, minute=59, second=59) + timedelta(days=7)
     }
     
-    db.collection("invites").add(invite_data)
+    await db.collection("invites").add(invite_data)
     
-    # Send email
-    email_sent = await send_invite_email(invite.email, invite_token, email, team_name)
+    # Send email after the response goes out
+    email_sent = bool(SMTP_USER and SMTP_PASSWORD)
+    if email_sent:
+        background_tasks.add_task(send_invite_email, invite.email, invite_token, email, team_name)
+    else:
+        logger.warning("⚠️ SMTP credentials not configured")
     
-    print(f"✅ Invite created for {invite.email}")
+    logger.info("✅ Invite created for %s", invite.email)
     
     return {
         "message": "Invitation sent successfully",
@@ -315,42 +893,35 @@ async def send_invite(invite: InviteRequest, user=Depends(verify_firebase_token)
     }
 
 
+# Valid-invite responses for the accept page, which validates on every render.
+# Only successes are kept, and accepting an invite drops its entry.
+_invite_cache = TTLCache(maxsize=1000, ttl=5)
+
+
 @app.get("/invite/validate")
 async def validate_invite(token: str):
-    print(f"🔍 [VALIDATE] Checking token: {token[:10]}...")
-    
-    invites = (
-        db.collection("invites")
-        .where("token", "==", token)
-        .where("status", "==", "pending")
-        .limit(1)
-        .stream()
-    )
-    invite_doc = next(invites, None)
-    
-    if not invite_doc:
-        raise HTTPException(status_code=404, detail="Invalid or expired invitation")
-    
-    invite_data = invite_doc.to_dict()
-    expires_at = invite_data.get("expires_at")
+    logger.debug("🔍 [VALIDATE] Checking token: %s...", token[:10])
 
-    # 👇 timezone-safe comparison
-    if expires_at and datetime.now(timezone.utc) > expires_at:
-        db.collection("invites").document(invite_doc.id).update({"status": "expired"})
-        raise HTTPException(status_code=410, detail="This invitation has expired")
+    cached = _invite_cache.get(token)
+    if cached is not None:
+        return cached
     
-    print(f"✅ Valid invite for {invite_data.get('email')}")
+    invite_doc = await get_pending_invite(token)
+    invite_data = invite_doc.to_dict()
+    logger.debug("✅ Valid invite for %s", invite_data.get('email'))
     
-    return {
+    result = {
         "valid": True,
         "email": invite_data.get("email"),
         "team_name": invite_data.get("team_name"),
         "role": invite_data.get("role")
     }
+    _invite_cache[token] = result
+    return result
 
 
 @app.post("/invite/accept/{token}")
-async def accept_invite(token: str, user=Depends(verify_firebase_token)):
+async def accept_invite(token: str, user=Depends(current_user)):
     """
     Accept an invitation and join the team
     User must be authenticated
@@ -358,35 +929,17 @@ async def accept_invite(token: str, user=Depends(verify_firebase_token)):
     uid = user["uid"]
     email = user.get("email")
     
-    print(f"✅ [ACCEPT] User {email} accepting invite with token: {token[:10]}...")
-
-    # Find invite by token
-    invites = (
-        db.collection("invites")
-        .where("token", "==", token)
-        .where("status", "==", "pending")
-        .limit(1)
-        .stream()
-    )
-    invite_doc = next(invites, None)
-
-    if not invite_doc:
-        raise HTTPException(status_code=404, detail="Invalid or expired invitation")
+    logger.info("✅ [ACCEPT] User %s accepting invite with token: %s...", email, token[:10])
 
+    invite_doc = await get_pending_invite(token)
     invite_data = invite_doc.to_dict()
 
     # Verify email matches
     if invite_data.get("email") != email:
         raise HTTPException(status_code=403, detail="This invitation is for a different email address")
 
-    # Check if expired
-    expires_at = invite_data.get("expires_at")
-    if expires_at and datetime.now(timezone.utc) > expires_at.replace(tzinfo=timezone.utc):
-        db.collection("invites").document(invite_doc.id).update({"status": "expired"})
-        raise HTTPException(status_code=410, detail="This invitation has expired")
-
     # Check if user already has a team
-    user_doc = db.collection("users").document(uid).get()
+    user_doc = await db.collection("users").document(uid).get()
     if user_doc.exists:
         user_data = user_doc.to_dict()
         if user_data.get("team_id"):
@@ -396,7 +949,7 @@ async def accept_invite(token: str, user=Depends(verify_firebase_token)):
     role = invite_data.get("role", "normal")
 
     # Add user to team
-    db.collection("users").document(uid).set(
+    await db.collection("users").document(uid).set(
         {
             "email": email,
             "team_id": team_id,
@@ -407,12 +960,12 @@ async def accept_invite(token: str, user=Depends(verify_firebase_token)):
     )
 
     # Update team members count
-    db.collection("teams").document(team_id).update(
+    await db.collection("teams").document(team_id).update(
         {"member_count": firestore.Increment(1)}
     )
 
     # Mark invite as accepted
-    db.collection("invites").document(invite_doc.id).update(
+    await db.collection("invites").document(invite_doc.id).update(
         {
             "status": "accepted",
             "accepted_at": datetime.now(timezone.utc),
@@ -420,7 +973,9 @@ async def accept_invite(token: str, user=Depends(verify_firebase_token)):
         }
     )
 
-    print(f"✅ User {email} joined team {team_id} as {role}")
+    _profile_cache.pop(uid, None)
+    _invite_cache.pop(token, None)
+    logger.info("✅ User %s joined team %s as %s", email, team_id, role)
 
     return {
         "message": "Successfully joined the team",
@@ -432,7 +987,7 @@ async def accept_invite(token: str, user=Depends(verify_firebase_token)):
 
 
 @app.get("/invite/list")
-async def list_invites(user=Depends(verify_firebase_token)):
+async def list_invites(background_tasks: BackgroundTasks, user=Depends(current_user)):
     """
     List all invites sent by the team (admin only)
     Includes status: pending, accepted, or expired
@@ -445,86 +1000,100 @@ async def list_invites(user=Depends(verify_firebase_token)):
     if role != "admin":
         raise HTTPException(status_code=403, detail="Only admins can view invites")
 
-    # Query all invites for that team
+    # Query all invites for that team, fetching only the fields returned
     invites = (
         db.collection("invites")
         .where("team_id", "==", team_id)
         .order_by("created_at", direction=firestore.Query.DESCENDING)
+        .select([
+            "email", "role", "invited_by_email", "accepted_by_uid", "team_name",
+            "status", "created_at", "expires_at", "accepted_at",
+        ])
         .stream()
     )
 
-    invite_list = []
-    now = datetime.now(timezone.utc)
-
-    for invite_doc in invites:
-        data = invite_doc.to_dict()
-        if not data:
-            continue
-
-        # Convert timestamps to ISO strings for frontend
-        for field in ["created_at", "expires_at", "accepted_at"]:
-            if field in data and data[field]:
-                data[field] = data[field].astimezone(timezone.utc).isoformat()
-
-        # determine the status dynamically
-        expires_at = invite_doc.to_dict().get("expires_at")
-        accepted_at = invite_doc.to_dict().get("accepted_at")
-        status = invite_doc.to_dict().get("status", "pending")
-
-        # make sure we handle the status properly
-        if accepted_at:
-            status = "accepted"
-        elif expires_at and datetime.now(timezone.utc) > expires_at:
-            status = "expired"
-        else:
-            status = "pending"
-
-        invite_list.append({
-            "id": invite_doc.id,
-            "email": data.get("email"),
-            "role": data.get("role", "normal"),
-            "invited_by_email": data.get("invited_by_email"),
-            "accepted_by_uid": data.get("accepted_by_uid"),
-            "team_name": data.get("team_name"),
-            "status": status,
-            "created_at": data.get("created_at"),
-            "expires_at": data.get("expires_at"),
-            "accepted_at": data.get("accepted_at"),
-        })
-
-    print(f"📋 Retrieved {len(invite_list)} invites for team {team_id}")
-
-    return {
-        "invites": invite_list,
-        "count": len(invite_list),
-    }
+    # Same body as {"invites": [...], "count": n}, sent as documents arrive;
+    # dumps() writes the UTC timestamps as ISO strings
+    async def body():
+        yield b'{"invites":['
+        count = 0
+        stale_ids = []
+        now = datetime.now(timezone.utc)
+
+        async for invite_doc in invites:
+            data = invite_doc.to_dict()
+            if not data:
+                continue
+
+            # Accepting an invite sets its status, so the stored value is trusted;
+            # only pending invites past their expiry still need correcting
+            status = data.get("status", "pending")
+            expires_at = data.get("expires_at")
+            if status == "pending" and expires_at and now > expires_at:
+                status = "expired"
+                stale_ids.append(invite_doc.id)
+
+            yield (b"," if count else b"") + dumps({
+                "id": invite_doc.id,
+                "email": data.get("email"),
+                "role": data.get("role", "normal"),
+                "invited_by_email": data.get("invited_by_email"),
+                "accepted_by_uid": data.get("accepted_by_uid"),
+                "team_name": data.get("team_name"),
+                "status": status,
+                "created_at": data.get("created_at"),
+                "expires_at": data.get("expires_at"),
+                "accepted_at": data.get("accepted_at"),
+            })
+            count += 1
+
+        # Background tasks run once the body is sent, so the next listing
+        # finds these expiries stored
+        if stale_ids:
+            background_tasks.add_task(mark_invites_expired, stale_ids)
+
+        logger.debug("📋 Retrieved %s invites for team %s", count, team_id)
+        yield b'],"count":' + dumps(count) + b"}"
+
+    return StreamingResponse(body(), media_type="application/json")
+
+
+# The dashboard re-fetches the profile on every route change; keep each one
+# for a few seconds. Joining or creating a team drops the user's entry.
+_profile_cache = TTLCache(maxsize=10000, ttl=5)
 
 
 @app.get("/user/profile")
-async def get_user_profile(user=Depends(verify_firebase_token)):
+async def get_user_profile(user=Depends(current_user)):
     """
     Get current user's profile including team info
     """
     uid = user["uid"]
     email = user.get("email")
+
+    profile = _profile_cache.get(uid)
+    if profile is not None:
+        return profile
     
-    user_doc = db.collection("users").document(uid).get()
+    user_doc = await db.collection("users").document(uid).get()
     
     if not user_doc.exists:
-        return {
+        profile = {
             "uid": uid,
             "email": email,
             "team_id": None,
             "role": None,
             "has_team": False
         }
+        _profile_cache[uid] = profile
+        return profile
     
     data = user_doc.to_dict()
     team_id = data.get("team_id")
     
     team_info = None
     if team_id:
-        team_doc = db.collection("teams").document(team_id).get()
+        team_doc = await db.collection("teams").document(team_id).get()
         if team_doc.exists:
             team_data = team_doc.to_dict()
             team_info = {
@@ -533,7 +1102,7 @@ async def get_user_profile(user=Depends(verify_firebase_token)):
                 "member_count": team_data.get("member_count", 0)
             }
     
-    return {
+    profile = {
         "uid": uid,
         "email": email,
         "team_id": team_id,
@@ -542,10 +1111,12 @@ async def get_user_profile(user=Depends(verify_firebase_token)):
         "team": team_info,
         "joined_at": data.get("joined_at").isoformat() if data.get("joined_at") else None
     }
+    _profile_cache[uid] = profile
+    return profile
 
 
 @app.post("/team/create")
-async def create_team(team_name: str, user=Depends(verify_firebase_token)):
+async def create_team(team_name: str, user=Depends(current_user)):
     """
     Create a new team (first user becomes admin)
     """
@@ -553,7 +1124,7 @@ async def create_team(team_name: str, user=Depends(verify_firebase_token)):
     email = user.get("email")
     
     # Check if user already has a team
-    user_doc = db.collection("users").document(uid).get()
+    user_doc = await db.collection("users").document(uid).get()
     if user_doc.exists and user_doc.to_dict().get("team_id"):
         raise HTTPException(status_code=400, detail="You are already part of a team")
     
@@ -561,7 +1132,7 @@ async def create_team(team_name: str, user=Depends(verify_firebase_token)):
     team_ref = db.collection("teams").document()
     team_id = team_ref.id
     
-    team_ref.set({
+    await team_ref.set({
         "name": team_name,
         "created_by": uid,
         "created_at": datetime.now(),
@@ -569,14 +1140,15 @@ async def create_team(team_name: str, user=Depends(verify_firebase_token)):
     })
     
     # Add user to team as admin
-    db.collection("users").document(uid).set({
+    await db.collection("users").document(uid).set({
         "email": email,
         "team_id": team_id,
         "role": "admin",
         "joined_at": datetime.now()
     }, merge=True)
     
-    print(f"✅ Team '{team_name}' created by {email}")
+    _profile_cache.pop(uid, None)
+    logger.info("✅ Team '%s' created by %s", team_name, email)
     
     return {
         "message": "Team created successfully",
@@ -588,7 +1160,8 @@ async def create_team(team_name: str, user=Depends(verify_firebase_token)):
 # ----------------------------------------------------------------
 #  --- MUSEUM LOGIC ---
 # ----------------------------------------------------------------
-STATUE_TO_SLOT = {
+# Lookup tables are read on every scan and never written; freeze them
+STATUE_TO_SLOT = MappingProxyType({
     "Ain Ghazal": "st1",
     "Atargatis": "st2",
     "Misha Stele": "st3",
@@ -611,12 +1184,12 @@ STATUE_TO_SLOT = {
     "Rosetta Stone": "st22",
     "Van Gogh Self Portrait": "st23",
     "Mona Lisa": "st24",
-}
+})
 
 # Reverse mapping for display names
-SLOT_TO_STATUE = {v: k for k, v in STATUE_TO_SLOT.items()}
+SLOT_TO_STATUE = MappingProxyType({v: k for k, v in STATUE_TO_SLOT.items()})
 
-LANG_TO_KEY = {
+LANG_TO_KEY = MappingProxyType({
     "Arabic": "ar",
     "English": "en",
     "French": "fr",
@@ -627,10 +1200,27 @@ LANG_TO_KEY = {
     "Russian": "ru",
     "Dutch": "nl",
     "Chinese": "zh",
-}
+})
 
 # Reverse mapping for display names
-KEY_TO_LANG = {v: k for k, v in LANG_TO_KEY.items()}
+KEY_TO_LANG = MappingProxyType({v: k for k, v in LANG_TO_KEY.items()})
+
+# Case-insensitive lookups for names sent by the handsets ("arabic" == "Arabic")
+_STATUE_LC = MappingProxyType({k.lower(): v for k, v in STATUE_TO_SLOT.items()})
+_LANG_LC = MappingProxyType({k.lower(): v for k, v in LANG_TO_KEY.items()})
+
+
+def classify_scan(statue_name: str, language_name: str, explicit_event: str):
+    """
+    Resolve a scan to (slot, lang_key, event_type).
+    Names are expected stripped; event_type is None when nothing matched.
+    """
+    slot = _STATUE_LC.get(statue_name.lower())
+    lang_key = _LANG_LC.get(language_name.lower())
+
+    if explicit_event == "statue" or explicit_event == "language":
+        return slot, lang_key, explicit_event
+    return slot, lang_key, "statue" if slot else ("language" if lang_key else None)
 
 AUDIO_LENGTHS = {
     "st1": {"ar": 10, "en": 110, "fr": 115, "sp": 118, "de": 112, "ja": 125, "ko": 122, "ru": 117, "nl": 113, "zh": 121},
@@ -656,11 +1246,66 @@ AUDIO_LENGTHS = {
     "st23": {"ar": 5, "en": 85, "fr": 88, "sp": 92, "de": 87, "ja": 95, "ko": 93, "ru": 89, "nl": 86, "zh": 94},
     "st24": {"ar": 10, "en": 5, "fr": 88, "sp": 92, "de": 87, "ja": 95, "ko": 93, "ru": 89, "nl": 86, "zh": 94},
 }
+AUDIO_LENGTHS = MappingProxyType({slot: MappingProxyType(langs) for slot, langs in AUDIO_LENGTHS.items()})
+
+# (slot, lang) -> seconds, so completion checks are a single lookup
+AUDIO_LENGTHS_FLAT = MappingProxyType({
+    (slot, lang): length
+    for slot, langs in AUDIO_LENGTHS.items()
+    for lang, length in langs.items()
+})
+
+# Repeat posts of the same scan from a device within this many seconds are ignored
+DUPLICATE_WINDOW = 2
+
+# A listen counts as complete once 90% of the audio has played
+AUDIO_THRESHOLDS = MappingProxyType({k: v * 0.9 for k, v in AUDIO_LENGTHS_FLAT.items()})
+
+
+def _scan_time(value) -> datetime:
+    """Aware datetime for a stored scan timestamp"""
+    if not isinstance(value, str):
+        return value
+    # Scans stored before the switch to server timestamps are ISO strings,
+    # the oldest of them naive server-local time
+    scanned_at = _parse_iso(value)
+    if scanned_at.tzinfo is None:
+        scanned_at = scanned_at.astimezone()
+    return scanned_at
+
+
+def _check_completion(prev_data: dict, now: datetime) -> Optional[Tuple[str, str]]:
+    """
+    (slot, lang) of the previous scan if it played for at least 90% of its
+    audio before `now`, otherwise None.
+    """
+    prev_statue = prev_data.get("statue") or ""
+    prev_language = prev_data.get("language") or ""
+    if prev_statue == "NULL" and prev_language == "NULL":
+        return None
+
+    prev_slot = _STATUE_LC.get(prev_statue.strip().lower())
+    prev_lang = _LANG_LC.get(prev_language.strip().lower())
+    prev_time = prev_data.get("timestamp")
+    logger.debug("🕐 Prev slot/lang: %s/%s, time=%s", prev_slot, prev_lang, prev_time)
+    if not (prev_slot and prev_lang and prev_time):
+        return None
+
+    threshold = AUDIO_THRESHOLDS.get((prev_slot, prev_lang))
+    if threshold is None:
+        return None
+
+    time_diff = (now - _scan_time(prev_time)).total_seconds()
+    logger.debug("⏱️ Time diff: %ss, threshold=%ss", time_diff, threshold)
+
+    if time_diff >= threshold:
+        return prev_slot, prev_lang
+    return None
 
 @app.get("/gettime")
-def get_time():
+async def get_time():
     now = datetime.now()
-    print(f"⏰ [DEBUG] Time requested: {now}")
+    logger.debug("⏰ [DEBUG] Time requested: %s", now)
     return {
         "current_time": now.strftime("%H:%M:%S"),
         "current_date": now.strftime("%Y-%m-%d"),
@@ -670,247 +1315,331 @@ def get_time():
 
 @app.post("/postdata")
 async def post_data(request: Request):
-    data = await request.json()
-    print(f"\n🛰️ [POSTDATA] Incoming data: {data}")
-
-    raw_device_id = data.get("id")
-    if not raw_device_id:
-        print("⚠️ [ERROR] Missing device ID")
+    # Decoded with orjson rather than FastAPI's stdlib json body parsing; the
+    # model still normalises the fields. Bad bodies get the usual 422.
+    body = await request.body()
+    try:
+        data = orjson.loads(body) if body else {}
+        scan = ScanIn.model_validate(data)
+    except orjson.JSONDecodeError as e:
+        raise RequestValidationError([{"type": "json_invalid", "loc": ("body",), "msg": str(e), "input": {}}])
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+
+    # stored_data1 keeps the body exactly as posted; `scan` only holds the
+    # normalised copies used for routing
+    logger.debug("🛰️ [POSTDATA] Incoming data: %s", data)
+
+    if not data.get("id") or not scan.id:
+        logger.warning("⚠️ [ERROR] Missing device ID")
         return {"error": "Missing 'id' in data"}
 
-    device_id = str(raw_device_id).strip().lower()
-    statue_name = (data.get("statue") or "").strip()
-    language_name = (data.get("language") or "").strip()
-    explicit_event = (data.get("event") or data.get("type") or "").strip().lower()
-
-    print(f"📱 Device ID: {device_id}")
-    print(f"🗿 Statue: {statue_name} | 🗣️ Language: {language_name} | 📝 Event: {explicit_event}")
+    device_id = scan.id.lower()
+    statue_name = scan.statue or ""
+    language_name = scan.language or ""
+    explicit_event = (scan.event or scan.type_ or "").lower()
 
-    lang_key = LANG_TO_KEY.get(language_name)
-    slot = STATUE_TO_SLOT.get(statue_name)
-
-    if explicit_event in {"statue", "language"}:
-        event_type = explicit_event
-    else:
-        event_type = "statue" if slot else ("language" if lang_key else None)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("📱 Device ID: %s", device_id)
+        logger.debug("🗿 Statue: %s | 🗣️ Language: %s | 📝 Event: %s", statue_name, language_name, explicit_event)
 
-    print(f"🧠 Event type resolved: {event_type}")
+    slot, lang_key, event_type = classify_scan(statue_name, language_name, explicit_event)
+    logger.debug("🧠 Event type resolved: %s", event_type)
 
-    prev_doc = db.collection("stored_data1").document(device_id).get()
+    # Completion tracking and duplicate detection only need these fields of the previous scan
+    prev_doc = await device_ref("stored_data1", device_id).get(
+        field_paths=["statue", "language", "event", "type", "timestamp"]
+    )
     prev_data = prev_doc.to_dict() if prev_doc.exists else None
-    print(f"📦 Previous scan: {prev_data}")
-
     is_turnoff = statue_name == "NULL" and language_name == "NULL"
-    print(f"🔌 Turnoff detected: {is_turnoff}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("📦 Previous scan: %s", prev_data)
+        logger.debug("🔌 Turnoff detected: %s", is_turnoff)
+
+    current_time = datetime.now(timezone.utc)
+
+    # Handsets sometimes post the same scan twice in quick succession. Drop the
+    # repeat without writing so the first scan's timestamp (when playback
+    # started) stays the one the completion check measures from.
+    # stored_data1 holds the previous body as posted, so compare raw values
+    if prev_data and prev_data.get("timestamp"):
+        same_scan = all(
+            prev_data.get(key) == data.get(key) for key in ("statue", "language", "event", "type")
+        )
+        if same_scan and (current_time - _scan_time(prev_data["timestamp"])).total_seconds() < DUPLICATE_WINDOW:
+            logger.debug("🔁 Duplicate scan from %s skipped", device_id)
+            return {"message": "Duplicate scan skipped"}
+
+    # The interaction and stored_data1 writes go out together in one commit
+    batch = db.batch()
 
-    current_time = datetime.now()
-    
     # --- SAVE TO TIME-SERIES COLLECTION ---
     # Save every interaction with timestamp to interactions collection
     if event_type == "statue" and slot and lang_key and not is_turnoff:
         interaction_data = {
             "device_id": device_id,
             "artifact": slot,
-            "artifact_name": statue_name,
+            "artifact_name": SLOT_TO_STATUE[slot],
             "language": lang_key,
-            "language_name": language_name,
+            "language_name": KEY_TO_LANG[lang_key],
             "timestamp": current_time,
             "date": current_time.strftime("%Y-%m-%d"),
             "event_type": "artifact_scan"
         }
         
         # Add to interactions collection (auto-generated document ID)
-        db.collection("interactions").add(interaction_data)
-        print(f"📊 [TIMESERIES] Saved interaction: {slot}-{lang_key} at {current_time}")
+        batch.set(db.collection("interactions").document(), interaction_data)
+        logger.debug("📊 [TIMESERIES] Queued interaction: %s-%s at %s", slot, lang_key, current_time)
 
     # --- COMPLETION TRACKING ---
-    if event_type == "statue" and slot and lang_key and prev_data:
-        prev_statue = prev_data.get("statue", "")
-        prev_language = prev_data.get("language", "")
-        prev_was_turnoff = prev_statue == "NULL" and prev_language == "NULL"
-
-        if not prev_was_turnoff:
-            prev_slot = STATUE_TO_SLOT.get(prev_statue)
-            prev_lang = LANG_TO_KEY.get(prev_language)
-            prev_time = prev_data.get("timestamp")
-            print(f"🕐 Prev slot/lang: {prev_slot}/{prev_lang}, time={prev_time}")
-
-            if prev_slot and prev_lang and prev_time:
-                prev_datetime = datetime.fromisoformat(prev_time.replace('Z', '+00:00')) if isinstance(prev_time, str) else prev_time
-                time_diff = (current_time - prev_datetime).total_seconds()
-                print(f"⏱️ Time diff: {time_diff}s")
-
-                if prev_slot in AUDIO_LENGTHS and prev_lang in AUDIO_LENGTHS[prev_slot]:
-                    audio_length = AUDIO_LENGTHS[prev_slot][prev_lang]
-                    threshold = audio_length * 0.9
-                    print(f"🎧 Audio length={audio_length}s, threshold={threshold}s")
-
-                    if time_diff >= threshold:
-                        print(f"✅ Completed listen detected for {prev_slot}-{prev_lang}")
-                        completion_ref = db.collection("stored_data2").document(device_id)
-                        completion_ref.set({
-                            "completions": {
-                                prev_slot: {
-                                    prev_lang: firestore.Increment(1)
-                                }
-                            }
-                        }, merge=True)
-
-    elif is_turnoff and prev_data:
-        prev_statue = prev_data.get("statue", "")
-        prev_language = prev_data.get("language", "")
-        prev_was_turnoff = prev_statue == "NULL" and prev_language == "NULL"
-
-        if not prev_was_turnoff:
-            prev_slot = STATUE_TO_SLOT.get(prev_statue)
-            prev_lang = LANG_TO_KEY.get(prev_language)
-            prev_time = prev_data.get("timestamp")
-            print(f"⚡ Turnoff -> Prev slot/lang: {prev_slot}/{prev_lang}, time={prev_time}")
-
-            if prev_slot and prev_lang and prev_time:
-                prev_datetime = datetime.fromisoformat(prev_time.replace('Z', '+00:00')) if isinstance(prev_time, str) else prev_time
-                time_diff = (current_time - prev_datetime).total_seconds()
-                print(f"⏱️ Turnoff Time diff: {time_diff}s")
-
-                if prev_slot in AUDIO_LENGTHS and prev_lang in AUDIO_LENGTHS[prev_slot]:
-                    audio_length = AUDIO_LENGTHS[prev_slot][prev_lang]
-                    threshold = audio_length * 0.9
-
-                    if time_diff >= threshold:
-                        print(f"✅ Completed listen (turnoff) for {prev_slot}-{prev_lang}")
-                        completion_ref = db.collection("stored_data2").document(device_id)
-                        completion_ref.set({
-                            "completions": {
-                                prev_slot: {
-                                    prev_lang: firestore.Increment(1)
-                                }
-                            }
-                        }, merge=True)
-
-    data["timestamp"] = current_time.isoformat()
-    db.collection("stored_data1").document(device_id).set(data)
-    print(f"💾 [DB] Stored current scan for {device_id}")
-
-    doc_ref = db.collection("stored_data2").document(device_id)
+    # A new scan or a turnoff ends whatever was playing before it
+    completed = None
+    if prev_data and ((event_type == "statue" and slot and lang_key) or is_turnoff):
+        completed = _check_completion(prev_data, current_time)
+
+    # Stored as a native Timestamp; it reads back as a datetime on the next scan
+    data["timestamp"] = firestore.SERVER_TIMESTAMP
+    batch.set(device_ref("stored_data1", device_id), data)
+    await batch.commit()
+    logger.debug("💾 [DB] Stored current scan for %s", device_id)
+
+    # Counters are only queued once the scan itself is stored
+    flushes = set()
+    if completed:
+        logger.info("✅ Completed listen detected for %s-%s", *completed)
+        flushes.add(enqueue_increment(device_id, "completions", *completed))
+        flushes.add(enqueue_completion_stat(*completed, "completed"))
 
     if event_type == "statue" and slot and lang_key:
-        print(f"📊 Incrementing artifacts.{slot}.{lang_key}")
-        doc_ref.set({"artifacts": {slot: {lang_key: firestore.Increment(1)}}}, merge=True)
-        return {"message": f"Incremented artifacts.{slot}.{lang_key}"}
-
-    if event_type == "language" and lang_key:
-        print(f"📊 Incrementing language.{lang_key}")
-        doc_ref.set({"language": {lang_key: firestore.Increment(1)}}, merge=True)
-        return {"message": f"Incremented language.{lang_key}"}
+        logger.debug("📊 Incrementing artifacts.%s.%s", slot, lang_key)
+        flushes.add(enqueue_increment(device_id, "artifacts", slot, lang_key))
+        flushes.add(enqueue_completion_stat(slot, lang_key, "total"))
+        message = f"Incremented artifacts.{slot}.{lang_key}"
+    elif event_type == "language" and lang_key:
+        logger.debug("📊 Incrementing language.%s", lang_key)
+        flushes.add(enqueue_increment(device_id, "language", lang_key))
+        message = f"Incremented language.{lang_key}"
+    else:
+        logger.debug("ℹ️ No increment performed.")
+        message = "No increment performed"
 
-    print("ℹ️ No increment performed.")
-    return {"message": "No increment performed"}
+    # Don't answer until the batches carrying these increments are committed.
+    # Shielded because other requests share the same flushes.
+    if flushes:
+        await asyncio.shield(asyncio.gather(*flushes))
+    return {"message": message}
 
 
 @app.get("/getdata")
-def get_data(user=Depends(verify_firebase_token)):
-    print(f"📤 [GETDATA] Requested by UID: {user['uid']}")
-    docs = db.collection("stored_data2").stream()
-    all_data = [{"id": d.id, **(d.to_dict() or {})} for d in docs]
-    print(f"🧾 Retrieved {len(all_data)} documents.")
-    return {"stored_data": all_data, "user_uid": user["uid"]}
+async def get_data(user=Depends(current_user)):
+    logger.debug("📤 [GETDATA] Requested by UID: %s", user['uid'])
+
+    # Same body as {"stored_data": [...], "user_uid": ...}, sent as documents arrive
+    async def body():
+        yield b'{"stored_data":['
+        separator = b""
+        async for chunk in stream_stored_data():
+            yield separator + chunk
+            separator = b","
+        yield b'],"user_uid":' + dumps(user["uid"]) + b"}"
+
+    return StreamingResponse(
+        body(),
+        media_type="application/json",
+        headers={"Cache-Control": f"private, max-age={SNAPSHOT_TTL}"},
+    )
+
+
+# Dashboards re-send the same few date ranges on every refresh
+@functools.lru_cache(maxsize=512)
+def _day_start(day: str) -> datetime:
+    """UTC midnight of a YYYY-MM-DD date; raises ValueError if malformed"""
+    try:
+        d = date.fromisoformat(day)
+    except ValueError:
+        # strptime also takes unpadded dates such as 2024-5-1
+        d = datetime.strptime(day, "%Y-%m-%d")
+    return datetime(d.year, d.month, d.day, tzinfo=timezone.utc)
+
+
+@functools.lru_cache(maxsize=512)
+def _day_end(day: str) -> datetime:
+    """Last second (UTC) of a YYYY-MM-DD date; raises ValueError if malformed"""
+    return _day_start(day).replace(hour=23, minute=59, second=59)
+
+
+# Largest page /analytics/interactions hands out when paging with `limit`
+MAX_PAGE_SIZE = 1000
 
 
 @app.get("/analytics/interactions")
-def get_interactions(
+async def get_interactions(
     start_date: str = None,
     end_date: str = None,
-    user=Depends(verify_firebase_token)
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fmt: str = Query("json", alias="format", pattern="^(json|ndjson)$"),
+    user=Depends(current_user)
 ):
     """
     Get time-series interaction data
     Query params:
     - start_date: YYYY-MM-DD format (optional)
     - end_date: YYYY-MM-DD format (optional)
+    - limit: maximum number of interactions to return, up to 1000 (optional)
+    - after: id of the last interaction of the previous page (optional)
+    - format: "json" (default) or "ndjson", one interaction per line
     """
-    print(f"📈 [INTERACTIONS] Requested by UID: {user['uid']}")
-    print(f"📅 Date range: {start_date} to {end_date}")
+    logger.debug("📈 [INTERACTIONS] Requested by UID: %s", user['uid'])
+    logger.debug("📅 Date range: %s to %s", start_date, end_date)
     
     query = db.collection("interactions")
     
     # Apply date filters if provided
     if start_date:
         try:
-            start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-            query = query.where("timestamp", ">=", start_dt)
+            query = query.where("timestamp", ">=", _day_start(start_date))
         except ValueError:
-            print(f"⚠️ Invalid start_date format: {start_date}")
+            logger.warning("⚠️ Invalid start_date format: %s", start_date)
     
     if end_date:
         try:
-            # Add one day to include the entire end date
-            end_dt = datetime.strptime(end_date, "%Y-%m-%d")
-            end_dt = end_dt.replace(hour=23, minute=59, second=59)
-            query = query.where("timestamp", "<=", end_dt)
+            # Extend to the last second to include the entire end date
+            query = query.where("timestamp", "<=", _day_end(end_date))
         except ValueError:
-            print(f"⚠️ Invalid end_date format: {end_date}")
+            logger.warning("⚠️ Invalid end_date format: %s", end_date)
     
     # Order by timestamp
     query = query.order_by("timestamp")
+
+    # Paging: resume after the given interaction, capped at `limit`
+    if after:
+        # Interaction ids are Firestore auto-ids; anything else would be a bad
+        # document path ("/") or a reserved id ("__x__") and fail in the client
+        if not (len(after) <= 128 and after.isascii() and after.isalnum()):
+            raise HTTPException(status_code=400, detail="Invalid 'after' interaction id")
+        cursor = await db.collection("interactions").document(after).get()
+        if not cursor.exists:
+            raise HTTPException(status_code=400, detail="Unknown 'after' interaction id")
+        query = query.start_after(cursor)
+    if limit:
+        query = query.limit(limit)
+
+    if fmt == "ndjson":
+        async def lines():
+            async for doc in query.stream():
+                yield dumps({"id": doc.id, **doc.to_dict()}) + b"\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
     
-    docs = query.stream()
-    interactions = []
-    
-    for doc in docs:
-        data = doc.to_dict()
-        # Convert timestamp to ISO string for JSON serialization
-        if "timestamp" in data:
-            data["timestamp"] = data["timestamp"].isoformat()
-        interactions.append({
-            "id": doc.id,
-            **data
-        })
-    
-    print(f"✅ Retrieved {len(interactions)} interactions")
-    
-    return {
-        "interactions": interactions,
-        "count": len(interactions),
-        "user_uid": user["uid"]
-    }
+    # Same body as {"interactions": [...], "count": n, "user_uid": ...}, sent
+    # as documents arrive; dumps() turns the timestamps into ISO strings
+    async def body():
+        yield b'{"interactions":['
+        count = 0
+        async for doc in query.stream():
+            yield (b"," if count else b"") + dumps({"id": doc.id, **doc.to_dict()})
+            count += 1
+        logger.debug("✅ Retrieved %s interactions", count)
+        yield b'],"count":' + dumps(count) + b',"user_uid":' + dumps(user["uid"]) + b"}"
 
+    return StreamingResponse(body(), media_type="application/json")
+
+
+# Both completion endpoints format the same records; a dashboard load hits
+# them together, so the records are built once and kept for a minute.
+_completion_cache = TTLCache(maxsize=1, ttl=60)
+_completion_task: Optional[asyncio.Task] = None
+
+
+async def _compute_completion_stats():
+    """
+    (records, total_scans, completed_listens): completion records per
+    (artifact, language), highest rate first, and their totals
+    """
+    global _completion_task
+    stats = _completion_cache.get("stats")
+    if stats is not None:
+        return stats
+
+    # The dashboard requests both endpoints at once; on a cold cache they
+    # share one Firestore read instead of racing two
+    if _completion_task is None or _completion_task.done():
+        _completion_task = asyncio.create_task(_build_completion_stats())
+    return await asyncio.shield(_completion_task)
+
+
+async def _build_completion_stats():
+    agg_doc = await device_ref(*COMPLETION_AGG).get()
+    stats = agg_doc.to_dict() or {}
 
-@app.get("/analytics/completion-rates")
-def get_completion_rates(user=Depends(verify_firebase_token)):
-    print(f"📈 [ANALYTICS] Completion rates requested by UID: {user['uid']}")
-    docs = db.collection("stored_data2").stream()
-    
     results = []
-    for doc in docs:
-        data = doc.to_dict() or {}
-        completions = data.get("completions", {})
-        artifacts = data.get("artifacts", {})
-        for artifact in artifacts:
-            for language in artifacts[artifact]:
-                total = artifacts[artifact][language]
-                completed = completions.get(artifact, {}).get(language, 0)
-                rate = (completed / total * 100) if total > 0 else 0
-                results.append({
-                    "artifact": artifact,
-                    "artifact_name": SLOT_TO_STATUE.get(artifact, artifact),
-                    "language": language,
-                    "language_name": KEY_TO_LANG.get(language, language),
-                    "total_scans": total,
-                    "completed_listens": completed,
-                    "completion_rate": round(rate, 2)
-                })
-    print(f"✅ Computed {len(results)} completion records.")
-    results.sort(key=lambda x: x["completion_rate"], reverse=True)
+    total_scans = completed_listens = 0
+    for artifact, languages in stats.items():
+        artifact_name = SLOT_TO_STATUE.get(artifact, artifact)
+        for language, counts in languages.items():
+            total = counts.get("total", 0)
+            if not total:
+                continue
+            completed = counts.get("completed", 0)
+            total_scans += total
+            completed_listens += completed
+            results.append({
+                "artifact": artifact,
+                "artifact_name": artifact_name,
+                "language": language,
+                "language_name": KEY_TO_LANG.get(language, language),
+                "total_scans": total,
+                "completed_listens": completed,
+                "completion_rate": round(completed / total * 100, 2)
+            })
+    logger.debug("✅ Computed %s completion records.", len(results))
+    results.sort(key=operator.itemgetter("completion_rate"), reverse=True)
+    stats = (results, total_scans, completed_listens)
+    _completion_cache["stats"] = stats
+    return stats
+
+
+@app.get("/analytics/completion-rates")
+async def get_completion_rates(
+    limit: Optional[int] = Query(None, ge=1),
+    user=Depends(current_user)
+):
+    """
+    Completion rate per artifact and language, highest first
+    Query params:
+    - limit: return only the top N records (optional)
+    """
+    logger.debug("📈 [ANALYTICS] Completion rates requested by UID: %s", user['uid'])
+    results, _, _ = await _compute_completion_stats()
+    # The cached records are already sorted, so the top N is a slice
+    if limit:
+        results = results[:limit]
     return {"completion_rates": results, "user_uid": user["uid"]}
 
 
 @app.get("/analytics/completion-summary")
-def get_completion_summary(user=Depends(verify_firebase_token)):
-    print(f"📊 [SUMMARY] Requested by UID: {user['uid']}")
-    completion_data = get_completion_rates(user)
+async def get_completion_summary(
+    include_breakdown: bool = True,
+    user=Depends(current_user)
+):
+    """
+    Overall completion rate
+    Query params:
+    - include_breakdown: also return the per-artifact records (default true);
+      false answers from the single totals document
+    """
+    logger.debug("📊 [SUMMARY] Requested by UID: %s", user['uid'])
+    if include_breakdown:
+        results, total_listens, completed_listens = await _compute_completion_stats()
+    else:
+        results = None
+        totals = (await device_ref(*COMPLETION_TOTALS).get()).to_dict() or {}
+        total_listens = totals.get("total_listens", 0)
+        completed_listens = totals.get("completed_listens", 0)
 
-    if not completion_data["completion_rates"]:
-        print("🔭 No completion data found.")
+    if not total_listens:
+        logger.debug("🔭 No completion data found.")
         return {
             "overall_completion_rate": 0,
             "total_listens": 0,
@@ -918,18 +1647,77 @@ def get_completion_summary(user=Depends(verify_firebase_token)):
             "user_uid": user["uid"]
         }
 
-    total_listens = sum(item["total_scans"] for item in completion_data["completion_rates"])
-    completed_listens = sum(item["completed_listens"] for item in completion_data["completion_rates"])
     overall_rate = (completed_listens / total_listens * 100) if total_listens > 0 else 0
-    print(f"📊 Overall completion: {overall_rate:.2f}% ({completed_listens}/{total_listens})")
+    logger.debug("📊 Overall completion: %.2f%% (%s/%s)", overall_rate, completed_listens, total_listens)
 
-    return {
+    summary = {
         "overall_completion_rate": round(overall_rate, 2),
         "total_listens": total_listens,
         "completed_listens": completed_listens,
-        "by_artifact": completion_data["completion_rates"],
-        "user_uid": user["uid"]
     }
+    if results is not None:
+        summary["by_artifact"] = results
+    summary["user_uid"] = user["uid"]
+    return summary
+
+
+@app.post("/analytics/cache/invalidate")
+async def invalidate_analytics_cache(user=Depends(current_user)):
+    """
+    Drop the cached completion records and stored_data2 snapshot (admin only)
+    Only clears the worker that serves the request; others expire on their TTL
+    """
+    _, role = await get_user_team(user["uid"])
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can clear the analytics cache")
+
+    _completion_cache.clear()
+    invalidate_snapshot()
+    logger.info("🧹 Analytics cache cleared by %s", user.get("email"))
+    return {"message": "Analytics cache cleared"}
+
+@app.post("/analytics/completions/rebuild")
+async def rebuild_completion_aggregate(user=Depends(current_user)):
+    """
+    Recompute agg/completions and agg/totals from the per-device counters (admin only)
+    One-off backfill for scans recorded before the aggregate existed. Run it
+    when the museum is quiet: increments committed by other workers while it
+    reads stored_data2 can be lost or counted twice.
+    """
+    _, role = await get_user_team(user["uid"])
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Only admins can rebuild analytics")
+
+    # Land this worker's pending counters before reading them back
+    await flush_writes()
+
+    stats = {}
+    pairs = 0
+    totals = {"total_listens": 0, "completed_listens": 0}
+    docs = db.collection("stored_data2").select(["artifacts", "completions"]).stream()
+    async for doc in docs:
+        data = doc.to_dict() or {}
+        completions = data.get("completions") or {}
+        for artifact, languages in (data.get("artifacts") or {}).items():
+            completed_for_artifact = completions.get(artifact) or {}
+            for language, total in languages.items():
+                counts = stats.setdefault(artifact, {}).get(language)
+                if counts is None:
+                    counts = stats[artifact][language] = {"total": 0, "completed": 0}
+                    pairs += 1
+                completed = completed_for_artifact.get(language, 0)
+                counts["total"] += total
+                counts["completed"] += completed
+                totals["total_listens"] += total
+                totals["completed_listens"] += completed
+
+    batch = db.batch()
+    batch.set(device_ref(*COMPLETION_AGG), stats)
+    batch.set(device_ref(*COMPLETION_TOTALS), totals)
+    await batch.commit()
+    _completion_cache.clear()
+    logger.info("🔁 Rebuilt completion aggregate (%s pairs) for %s", pairs, user.get("email"))
+    return {"message": "Completion aggregate rebuilt", "pairs": pairs}
 
 # ----------------------------------------------------------------
 #  --- SERVER RUN ---
@@ -938,10 +1726,26 @@ if __name__ == "__main__":
     import uvicorn
     here = pathlib.Path(__file__).parent.resolve()
     os.chdir(here)
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        reload_dirs=[str(here)],
-    )
+    if os.getenv("DEV"):
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            reload=True,
+            reload_dirs=[str(here)],
+        )
+    else:
+        workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+        # Workers re-import this module; they read it to split the write budget
+        os.environ["WEB_CONCURRENCY"] = str(workers)
+        # "auto" picks uvloop and httptools when they are installed
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=workers,
+            loop="auto",
+            http="auto",
+            # One line per request is per-request detail; only log it at DEBUG
+            access_log=logger.isEnabledFor(logging.DEBUG),
+        )
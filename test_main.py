@@ -0,0 +1,541 @@
+import asyncio
+import operator
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from google.api_core import exceptions as gcp_exceptions
+
+import main
+from main import app
+
+client = TestClient(app)
+
+
+# ----------------------------------------------------------------
+#  --- IN-MEMORY FIRESTORE ---
+# ----------------------------------------------------------------
+# Just enough of the async client for the endpoints under test: documents
+# live in a dict keyed by (collection, id) and every committed write is logged.
+_OPS = {"==": operator.eq, ">": operator.gt, ">=": operator.ge, "<=": operator.le}
+
+
+class FakeSnapshot:
+    def __init__(self, data, doc_id=None):
+        self._data = data
+        self.id = doc_id
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeRef:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.id = path[-1]
+
+    async def get(self, field_paths=None):
+        return FakeSnapshot(self.db.docs.get(self.path), self.id)
+
+    async def update(self, data):
+        self.db.docs[self.path].update(data)
+        self.db.writes.append((self.path, data, True))
+
+
+class FakeQuery:
+    def __init__(self, db, name, filters=(), order=None, count=None, after=None):
+        self.db = db
+        self.name = name
+        self.filters = filters
+        self.order = order
+        self.count = count
+        self.after = after
+
+    def _with(self, **changes):
+        fields = dict(filters=self.filters, order=self.order, count=self.count, after=self.after)
+        fields.update(changes)
+        return FakeQuery(self.db, self.name, **fields)
+
+    def where(self, field, op, value):
+        return self._with(filters=self.filters + ((field, op, value),))
+
+    def select(self, fields):
+        return self
+
+    def order_by(self, field, direction=None):
+        return self._with(order=field)
+
+    def limit(self, count):
+        return self._with(count=count)
+
+    def start_after(self, snapshot):
+        return self._with(after=snapshot.id)
+
+    async def get(self):
+        if self.db.missing_indexes and any(op != "==" for _, op, _ in self.filters):
+            raise gcp_exceptions.FailedPrecondition("The query requires an index")
+        docs = []
+        for (collection, doc_id), data in self.db.docs.items():
+            if collection != self.name:
+                continue
+            # Like Firestore, a filter never matches a missing field
+            if all(data.get(f) is not None and _OPS[op](data.get(f), v) for f, op, v in self.filters):
+                docs.append(FakeSnapshot(data, doc_id))
+        if self.order:
+            docs.sort(key=lambda d: d.to_dict()[self.order])
+        if self.after:
+            ids = [d.id for d in docs]
+            docs = docs[ids.index(self.after) + 1:] if self.after in ids else []
+        return docs[:self.count] if self.count else docs
+
+    async def stream(self):
+        for doc in await self.get():
+            yield doc
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(db, name)
+
+    def document(self, doc_id=None):
+        if doc_id is None:
+            doc_id = f"auto{len(self.db.writes)}"
+        return FakeRef(self.db, (self.name, doc_id))
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.pending = []
+
+    def set(self, ref, data, merge=False):
+        self.pending.append((ref.path, data, merge))
+
+    async def commit(self, retry=None):
+        self.db.commits += 1
+        if self.db.commit_errors:
+            raise self.db.commit_errors.pop(0)
+        for path, data, merge in self.pending:
+            if not merge:
+                self.db.docs[path] = data
+            self.db.writes.append((path, data, merge))
+
+
+class FakeDB:
+    def __init__(self):
+        self.docs = {}
+        self.writes = []
+        # Set to make range queries fail as they do before the indexes are deployed
+        self.missing_indexes = False
+        # Raised by the next batch commits, one per commit
+        self.commit_errors = []
+        self.commits = 0
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(main, "db", db)
+    # TestClient runs each request on its own event loop; don't reuse the
+    # writer state left behind by the previous one
+    monkeypatch.setattr(main, "_device_counters", main.CounterQueue(main.FLUSH_INTERVAL))
+    monkeypatch.setattr(main, "_agg_counters", main.CounterQueue(main.AGG_FLUSH_INTERVAL))
+    monkeypatch.setattr(main, "device_ref", lambda collection, doc_id: FakeRef(db, (collection, doc_id)))
+    return db
+
+
+# ----------------------------------------------------------------
+#  --- HELPERS ---
+# ----------------------------------------------------------------
+def test_classify_scan():
+    assert main.classify_scan("ain ghazal", "ENGLISH", "") == ("st1", "en", "statue")
+    assert main.classify_scan("", "Arabic", "") == (None, "ar", "language")
+    assert main.classify_scan("Ain Ghazal", "English", "language") == ("st1", "en", "language")
+    assert main.classify_scan("Unknown", "Klingon", "") == (None, None, None)
+
+
+def test_scan_time():
+    aware = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+    assert main._scan_time(aware) is aware
+    assert main._scan_time("2024-05-01T12:00:00+00:00") == aware
+    # Old naive strings are read as server-local time
+    assert main._scan_time("2024-05-01T12:00:00").tzinfo is not None
+
+
+def test_check_completion():
+    now = datetime.now(timezone.utc)
+    prev = {"statue": "Ain Ghazal", "language": "English"}
+
+    # st1/en is 110 s long; 90% of it has to have played
+    assert main._check_completion({**prev, "timestamp": now - timedelta(seconds=100)}, now) == ("st1", "en")
+    assert main._check_completion({**prev, "timestamp": now - timedelta(seconds=50)}, now) is None
+    assert main._check_completion({"statue": "NULL", "language": "NULL", "timestamp": now}, now) is None
+    assert main._check_completion({"statue": "Unknown", "language": "English", "timestamp": now}, now) is None
+    assert main._check_completion(prev, now) is None
+
+
+def test_build_payloads():
+    payloads = main._build_payloads({
+        (("stored_data2", "dev1"), ("artifacts", "st1", "en")): 2,
+        (("stored_data2", "dev1"), ("language", "en")): 1,
+        (main.COMPLETION_TOTALS, ("total_listens",)): 3,
+    })
+    assert set(payloads) == {("stored_data2", "dev1"), main.COMPLETION_TOTALS}
+    assert payloads[("stored_data2", "dev1")]["artifacts"]["st1"]["en"].value == 2
+    assert payloads[("stored_data2", "dev1")]["language"]["en"].value == 1
+    assert payloads[main.COMPLETION_TOTALS]["total_listens"].value == 3
+
+
+async def _flush_one_increment():
+    flushed = main.enqueue_increment("dev1", "language", "en")
+    await asyncio.wait_for(asyncio.shield(flushed), timeout=2)
+
+
+def test_flush_requeues_rejected_batch(fake_db):
+    fake_db.commit_errors = [gcp_exceptions.ServiceUnavailable("unavailable")]
+
+    asyncio.run(_flush_one_increment())
+    assert fake_db.commits == 2
+    assert fake_db.writes[0][1]["language"]["en"].value == 1
+    assert not main._device_counters.pending and not main._device_counters._requeues
+
+
+def test_flush_gives_up_on_persistent_rejection(fake_db):
+    fake_db.commit_errors = [gcp_exceptions.ServiceUnavailable("unavailable")] * 10
+
+    with pytest.raises(gcp_exceptions.ServiceUnavailable):
+        asyncio.run(_flush_one_increment())
+    assert fake_db.commits == main.MAX_REQUEUES + 1
+    assert not main._device_counters.pending and not main._device_counters._requeues
+
+
+def test_flush_does_not_retry_other_errors(fake_db):
+    # A commit that timed out may already have been applied
+    fake_db.commit_errors = [gcp_exceptions.DeadlineExceeded("timeout")]
+
+    with pytest.raises(gcp_exceptions.DeadlineExceeded):
+        asyncio.run(_flush_one_increment())
+    assert fake_db.commits == 1
+    assert not main._device_counters.pending
+
+
+def test_aggregates_flush_on_their_own_interval(fake_db):
+    async def scenario():
+        device = main.enqueue_increment("dev1", "artifacts", "st1", "en")
+        agg = main.enqueue_completion_stat("st1", "en", "total")
+        await asyncio.wait_for(asyncio.shield(device), timeout=main.AGG_FLUSH_INTERVAL / 2)
+        assert [path for path, _, _ in fake_db.writes] == [("stored_data2", "dev1")]
+        await asyncio.wait_for(asyncio.shield(agg), timeout=main.AGG_FLUSH_INTERVAL * 2)
+
+    asyncio.run(scenario())
+    assert {path for path, _, _ in fake_db.writes} == {
+        ("stored_data2", "dev1"), main.COMPLETION_AGG, main.COMPLETION_TOTALS,
+    }
+
+
+def test_day_bounds():
+    assert main._day_start("2024-05-01") == datetime(2024, 5, 1, tzinfo=timezone.utc)
+    assert main._day_end("2024-05-01") == datetime(2024, 5, 1, 23, 59, 59, tzinfo=timezone.utc)
+    assert main._day_start("2024-5-1") == main._day_start("2024-05-01")
+    with pytest.raises(ValueError):
+        main._day_start("01/05/2024")
+
+
+# ----------------------------------------------------------------
+#  --- ENDPOINTS ---
+# ----------------------------------------------------------------
+def test_get_time():
+    response = client.get("/gettime")
+    assert response.status_code == 200
+    assert "current_time" in response.json()
+
+
+def test_postdata(fake_db):
+    response = client.post("/postdata", json={
+        "id": "test-device",
+        "statue": "Ain Ghazal",
+        "language": "English"
+    })
+    assert response.status_code == 200
+    assert response.json() == {"message": "Incremented artifacts.st1.en"}
+
+    # The body is stored as posted, and the counters are committed before the response
+    stored = fake_db.docs[("stored_data1", "test-device")]
+    assert stored["statue"] == "Ain Ghazal"
+    written = {path for path, _, merge in fake_db.writes if merge}
+    assert {("stored_data2", "test-device"), main.COMPLETION_AGG, main.COMPLETION_TOTALS} <= written
+
+
+def test_postdata_missing_id(fake_db):
+    response = client.post("/postdata", json={"id": 0, "statue": "Ain Ghazal"})
+    assert response.json() == {"error": "Missing 'id' in data"}
+    assert not fake_db.writes
+
+
+def test_postdata_duplicate_skipped(fake_db):
+    scan = {"id": "test-device", "statue": "Ain Ghazal", "language": "English"}
+    fake_db.docs[("stored_data1", "test-device")] = {**scan, "timestamp": datetime.now(timezone.utc)}
+
+    response = client.post("/postdata", json=scan)
+    assert response.json() == {"message": "Duplicate scan skipped"}
+    assert not fake_db.writes
+
+
+def test_postdata_turnoff_counts_completion(fake_db):
+    fake_db.docs[("stored_data1", "test-device")] = {
+        "id": "test-device",
+        "statue": "Ain Ghazal",
+        "language": "English",
+        "timestamp": datetime.now(timezone.utc) - timedelta(seconds=200),
+    }
+
+    response = client.post("/postdata", json={"id": "test-device", "statue": "NULL", "language": "NULL"})
+    assert response.json() == {"message": "No increment performed"}
+
+    device_writes = [data for path, data, merge in fake_db.writes if path == ("stored_data2", "test-device")]
+    assert device_writes[0]["completions"]["st1"]["en"].value == 1
+    assert fake_db.docs[("stored_data1", "test-device")]["statue"] == "NULL"
+
+
+# ----------------------------------------------------------------
+#  --- INVITES ---
+# ----------------------------------------------------------------
+def _invite(expires_in):
+    return {
+        "token": "tok",
+        "status": "pending",
+        "email": "new@example.com",
+        "team_id": "team1",
+        "expires_at": datetime.now(timezone.utc) + expires_in,
+    }
+
+
+@pytest.mark.parametrize("missing_indexes", [False, True])
+def test_pending_invite_found(fake_db, missing_indexes):
+    fake_db.missing_indexes = missing_indexes
+    fake_db.docs[("invites", "inv1")] = _invite(timedelta(days=1))
+
+    assert asyncio.run(main.get_pending_invite("tok")).id == "inv1"
+
+
+@pytest.mark.parametrize("missing_indexes", [False, True])
+def test_pending_invite_expired(fake_db, missing_indexes):
+    fake_db.missing_indexes = missing_indexes
+    fake_db.docs[("invites", "inv1")] = _invite(timedelta(days=-1))
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.get_pending_invite("tok"))
+    assert exc.value.status_code == 410
+    assert fake_db.docs[("invites", "inv1")]["status"] == "expired"
+
+
+def test_pending_invite_unknown(fake_db):
+    fake_db.docs[("invites", "inv1")] = _invite(timedelta(days=1))
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.get_pending_invite("other"))
+    assert exc.value.status_code == 404
+
+
+# ----------------------------------------------------------------
+#  --- AUTH ---
+# ----------------------------------------------------------------
+AUTH = {"Authorization": "Bearer test-token"}
+
+
+@pytest.fixture
+def verified_tokens(monkeypatch):
+    """Tokens passed to Firebase for verification; each is valid for an hour"""
+    verified = []
+
+    def verify_id_token(token):
+        verified.append(token)
+        return {"uid": "user1", "email": "user1@example.com", "exp": time.time() + 3600}
+
+    monkeypatch.setattr(main, "_token_cache", main.TTLCache(maxsize=10, ttl=3300))
+    monkeypatch.setattr(main.firebase_auth, "verify_id_token", verify_id_token)
+    return verified
+
+
+def test_token_cache_reuses_verified_token(verified_tokens):
+    asyncio.run(main.verify_firebase_token("Bearer test-token"))
+    asyncio.run(main.verify_firebase_token("Bearer test-token"))
+    assert verified_tokens == ["test-token"]
+
+
+def test_token_cache_reverifies_near_expiry(verified_tokens):
+    decoded = asyncio.run(main.verify_firebase_token("Bearer test-token"))
+    # Inside the 30 s slack before exp the cached entry is not trusted
+    decoded["exp"] = time.time() + 20
+    asyncio.run(main.verify_firebase_token("Bearer test-token"))
+    assert verified_tokens == ["test-token", "test-token"]
+
+
+def test_protected_path_without_token_is_401():
+    response = client.get("/getdata", headers={"Origin": "http://localhost:3000"})
+    assert response.status_code == 401
+    assert response.json() == {"detail": "Missing Authorization header"}
+    # The dashboard can only read the 401 if CORS headers are on it
+    assert response.headers["access-control-allow-origin"] == "http://localhost:3000"
+
+
+def test_protected_path_with_bad_scheme_is_401():
+    response = client.get("/analytics/completion-rates", headers={"Authorization": "Token abc"})
+    assert response.status_code == 401
+    assert response.json() == {"detail": "Invalid token format"}
+
+
+def test_preflight_skips_token_check():
+    response = client.options("/getdata", headers={
+        "Origin": "http://localhost:3000",
+        "Access-Control-Request-Method": "GET",
+        "Access-Control-Request-Headers": "Authorization",
+    })
+    assert response.status_code == 200
+    assert response.headers["access-control-allow-origin"] == "http://localhost:3000"
+
+
+def test_unprotected_path_skips_token_check():
+    assert client.get("/gettime").status_code == 200
+
+
+# ----------------------------------------------------------------
+#  --- ADMIN ANALYTICS ---
+# ----------------------------------------------------------------
+def _set_role(fake_db, role):
+    fake_db.docs[("users", "user1")] = {"team_id": "team1", "role": role}
+
+
+def test_cache_invalidate_requires_admin(fake_db, verified_tokens):
+    _set_role(fake_db, "normal")
+    main._completion_cache["stats"] = ([], 0, 0)
+
+    response = client.post("/analytics/cache/invalidate", headers=AUTH)
+    assert response.status_code == 403
+    assert "stats" in main._completion_cache
+
+
+def test_cache_invalidate_clears_caches(fake_db, verified_tokens):
+    _set_role(fake_db, "admin")
+    main._completion_cache["stats"] = ([], 0, 0)
+
+    response = client.post("/analytics/cache/invalidate", headers=AUTH)
+    assert response.status_code == 200
+    assert "stats" not in main._completion_cache
+    assert main._snapshot_cache["ts"] == 0.0
+
+
+def test_rebuild_requires_admin(fake_db, verified_tokens):
+    _set_role(fake_db, "normal")
+
+    response = client.post("/analytics/completions/rebuild", headers=AUTH)
+    assert response.status_code == 403
+    assert not fake_db.writes
+
+
+def test_rebuild_sums_device_counters(fake_db, verified_tokens):
+    _set_role(fake_db, "admin")
+    fake_db.docs[("stored_data2", "dev1")] = {
+        "artifacts": {"st1": {"en": 3, "ar": 1}},
+        "completions": {"st1": {"en": 2}},
+    }
+    fake_db.docs[("stored_data2", "dev2")] = {"artifacts": {"st1": {"en": 1}}}
+
+    response = client.post("/analytics/completions/rebuild", headers=AUTH)
+    assert response.json() == {"message": "Completion aggregate rebuilt", "pairs": 2}
+    assert fake_db.docs[main.COMPLETION_AGG] == {
+        "st1": {"en": {"total": 4, "completed": 2}, "ar": {"total": 1, "completed": 0}},
+    }
+    assert fake_db.docs[main.COMPLETION_TOTALS] == {"total_listens": 5, "completed_listens": 2}
+
+
+# ----------------------------------------------------------------
+#  --- INTERACTIONS ---
+# ----------------------------------------------------------------
+def _seed_interactions(fake_db):
+    start = datetime(2024, 5, 1, 9, 0, tzinfo=timezone.utc)
+    for i in range(3):
+        fake_db.docs[("interactions", f"int{i}")] = {
+            "device_id": "dev1",
+            "artifact": "st1",
+            "timestamp": start + timedelta(minutes=i),
+        }
+
+
+def test_interactions_pages_with_after_and_limit(fake_db, verified_tokens):
+    _seed_interactions(fake_db)
+
+    response = client.get("/analytics/interactions?limit=1&after=int0", headers=AUTH)
+    body = response.json()
+    assert [row["id"] for row in body["interactions"]] == ["int1"]
+    assert body["count"] == 1
+
+
+def test_interactions_ndjson(fake_db, verified_tokens):
+    _seed_interactions(fake_db)
+
+    response = client.get("/analytics/interactions?format=ndjson", headers=AUTH)
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [main.orjson.loads(line) for line in response.content.splitlines()]
+    assert [row["id"] for row in rows] == ["int0", "int1", "int2"]
+    assert rows[0]["timestamp"] == "2024-05-01T09:00:00+00:00"
+
+
+@pytest.mark.parametrize("after", ["a/b", "__x__", "x" * 129])
+def test_interactions_rejects_malformed_after(fake_db, verified_tokens, after):
+    response = client.get("/analytics/interactions", params={"after": after}, headers=AUTH)
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid 'after' interaction id"}
+
+
+def test_interactions_rejects_unknown_after(fake_db, verified_tokens):
+    response = client.get("/analytics/interactions?after=missing", headers=AUTH)
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Unknown 'after' interaction id"}
+
+
+@pytest.mark.parametrize("query", ["limit=0", f"limit={main.MAX_PAGE_SIZE + 1}", "format=xml"])
+def test_interactions_rejects_bad_query(fake_db, verified_tokens, query):
+    response = client.get(f"/analytics/interactions?{query}", headers=AUTH)
+    assert response.status_code == 422
+
+
+# ----------------------------------------------------------------
+#  --- COMPLETION ANALYTICS ---
+# ----------------------------------------------------------------
+@pytest.fixture
+def completion_docs(fake_db, monkeypatch):
+    monkeypatch.setattr(main, "_completion_cache", main.TTLCache(maxsize=1, ttl=60))
+    monkeypatch.setattr(main, "_completion_task", None)
+    fake_db.docs[main.COMPLETION_AGG] = {"st1": {"en": {"total": 4, "completed": 3}}}
+    fake_db.docs[main.COMPLETION_TOTALS] = {"total_listens": 4, "completed_listens": 3}
+    return fake_db
+
+
+def test_completion_summary_with_breakdown(completion_docs, verified_tokens):
+    body = client.get("/analytics/completion-summary", headers=AUTH).json()
+    assert body["overall_completion_rate"] == 75.0
+    assert [row["artifact"] for row in body["by_artifact"]] == ["st1"]
+
+
+def test_completion_summary_without_breakdown(completion_docs, verified_tokens):
+    # Answered from agg/totals alone
+    del completion_docs.docs[main.COMPLETION_AGG]
+
+    body = client.get("/analytics/completion-summary?include_breakdown=false", headers=AUTH).json()
+    assert body == {
+        "overall_completion_rate": 75.0,
+        "total_listens": 4,
+        "completed_listens": 3,
+        "user_uid": "user1",
+    }